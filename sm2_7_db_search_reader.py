@@ -32,15 +32,43 @@
 #       appended to the end (e.g. ANOC3 or TNOC2). If there are no
 #       values for a specific NOC then a file is still made but is empty.
 #
-#       Note that this program expects to find only True and Apparent
-#       number of contributor values that range from 1 to 5 when making
-#       the output files. If more than that is needed you can copy and
-#       paste a new output filter to include 6 or more NOC.
+#       Note that empty files are only made for True and Apparent number
+#       of contributor values that range from 1 to 5. Files for 6 or more
+#       NOC are made only when there are values for them.
+#
+#       If NOC_OUTPUT is set to 'parquet' the split CSV files are not made.
+#       Instead two Parquet datasets are saved that are partitioned by the
+#       true and apparent number of contributors so only the needed
+#       partition has to be read. This requires pyarrow. If there are no
+#       results each dataset holds a single empty partition for NOC 0.
 #
 
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
+import numpy as np
 import pandas as pd
-import glob
+import logging
+import multiprocessing
+import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+# pyarrow is optional. It writes the CSV files from columnar buffers and
+#       the files are written with pandas when it is not installed.
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# pygixml is optional. When it is installed the 'results.xml' files are
+#       read with it instead of lxml as it is faster on small files. It
+#       loads each whole file rather than streaming it like lxml does.
+try:
+    import pygixml
+except ImportError:
+    pygixml = None
 
 
 #############################################################################
@@ -54,6 +82,11 @@ DIRECTORY = r'DB Results'
 #       can also indicate the full path for the file as in the DIRECTORY
 #       of the file as in the DIRECTORY variable above.
 DECON_FILE = "LR_data.csv"
+#
+# The NOC_OUTPUT variable sets how the data split by number of contributors
+#       is saved. Use 'csv' for one CSV file per NOC or 'parquet' for
+#       partitioned Parquet datasets.
+NOC_OUTPUT = 'csv'
 #############################################################################
 
 
@@ -61,24 +94,38 @@ DECON_FILE = "LR_data.csv"
 decon_data = pd.read_csv(DECON_FILE)
 decon_data = decon_data.filter(items=["Sample ID", "DNA Amount 1", "DNA Amount 2", "DNA Amount 3",
                         "DNA Amount 4", "DNA Amount 5"])
-ex4_data_temp = decon_data[["DNA Amount 1", "DNA Amount 2", "DNA Amount 3",
-                        "DNA Amount 4", "DNA Amount 5"]].values.tolist()
-temptemp = []
-for x in ex4_data_temp:
-    try:
-        lowest = min(filter(lambda i: i > 0, x))
-    except ValueError:
-        print("caught")
-        lowest = 0
-    temptemp.append(lowest)
-decon_data["Lowest DNA Amount"] = temptemp
-#print(temptemp)
-#print(ex4_data)
+# Zero amounts are not contributors so mask them out before taking the minimum.
+#       Rows with no positive amount get a lowest amount of 0.
+dna_amounts = decon_data[["DNA Amount 1", "DNA Amount 2", "DNA Amount 3",
+                          "DNA Amount 4", "DNA Amount 5"]].to_numpy(dtype=float)
+lowest_amounts = np.where(dna_amounts > 0, dna_amounts, np.inf).min(axis=1)
+lowest_amounts[np.isinf(lowest_amounts)] = 0
+decon_data["Lowest DNA Amount"] = lowest_amounts
+
+# Lowest DNA amount keyed by sample ID so each results file is a single lookup.
+#       A sample can be in the decon data more than once (e.g. run with
+#       different NOC) and the first row for it is the one used.
+_first_decon_rows = decon_data.drop_duplicates("Sample ID", keep="first")
+_LOWEST_BY_SAMPLE = dict(zip(_first_decon_rows["Sample ID"].values, _first_decon_rows["Lowest DNA Amount"].values))
 
 
 # Constants: LRCUTOFF sets the lower limit of reported LRs
 LRCUTOFF = -1
 
+# Output columns in the order they are written to the CSV files
+COLUMNS = ['Run Type', 'Case Number', 'Sample ID', 'Case Notes',
+           'Seed', 'Contributors', 'True Contributors',
+           'Contributor 1', 'Contributor 2', 'Contributor 3',
+           'Contributor 4', 'Contributor 5', 'True/Non', "Template RFU",
+           'Profile Type', 'Profile ID', 'LR']
+
+# Numeric columns are converted once when their arrays are built
+COLUMN_DTYPES = {'Seed': np.int64,
+                 'Contributors': np.int64,
+                 'True Contributors': np.int64,
+                 'Template RFU': np.float64,
+                 'LR': np.float64}
+
 mixDictionary = {
     'M1-2': ['12M', '14F', '', '', ''],
     'M1-3': ['9F', '21F', '22M', '', ''],
@@ -102,198 +149,312 @@ duplicateSamplesDictionary = {
 
 
 # These are samples with profiles that match other samples
-duplicatesSet = {'Mock_4',
-                 'Mock_8',
-                 'Mock_17',
-                 'Mock_19',
-                 'Mock_22_EC',
-                 'Mock_22_SF',
-                 'Mock_23_EC',
-                 'Mock_23_SF',
-                 'Mock_24_EC',
-                 'Mock_24_SF',
-                 'Mock_26_A',
-                 'Mock_26_B',
-                 'Mock_27_A',
-                 'FD_1',
-                 'FD_4',
-                 'FD_6',
-                 'FD_15',
-                 'FD_19',
-                 'FD_20',
-                 'FD_21B',
-                 'FD_33B',
-                 }
+duplicatesSet = frozenset({'Mock_4',
+                           'Mock_8',
+                           'Mock_17',
+                           'Mock_19',
+                           'Mock_22_EC',
+                           'Mock_22_SF',
+                           'Mock_23_EC',
+                           'Mock_23_SF',
+                           'Mock_24_EC',
+                           'Mock_24_SF',
+                           'Mock_26_A',
+                           'Mock_26_B',
+                           'Mock_27_A',
+                           'FD_1',
+                           'FD_4',
+                           'FD_6',
+                           'FD_15',
+                           'FD_19',
+                           'FD_20',
+                           'FD_21B',
+                           'FD_33B',
+                           })
+
+
+# The sample tags read from each 'results.xml' file. With lxml these are
+#       streamed with iterparse so the whole document is never built in memory.
+_SAMPLE_TAGS = ('caseNumber', 'sampleId', 'caseNotes', 'seed', 'contributors')
+_ITERPARSE_TAGS = ('databaseSearchResults',) + _SAMPLE_TAGS + ('stdResult',)
+
+
+# Contributor tuples so the lists in mixDictionary are never copied or changed
+_MIX = {k: tuple(v) for k, v in mixDictionary.items()}
+
+# Samples that are renamed to the sample they duplicate before being kept
+_RENAMED_SAMPLES = {'Mock_6': '40F'}
+
+
+def columnArray(column, values):
+    """Returns the values for one output column as a NumPy array of
+    the column's type. Text columns are kept as object arrays."""
+
+    return np.array(values, dtype=COLUMN_DTYPES.get(column, object))
 
 
 def contributorsList(mix_num, contributors):
-    mixCode = mix_num + '-' + contributors
-    try:
-        return mixDictionary[mixCode]
-    except KeyError:
-        print("caught")
-        return ['', '', '', '', '']
-
+    mixCode = f'{mix_num}-{contributors}'
+    contrib_list = _MIX.get(mixCode)
+    if contrib_list is None:
+        # Without contributors every result is a Non-Contributor
+        log.warning("Unknown mix code %s, no true contributors for this sample", mixCode)
+        return ('', '', '', '', '')
+    return contrib_list
+
+
+
+def _iterResultsLxml(file, values):
+    """Streams a results file with lxml. Fills values with the first
+    occurrence of each sample tag and yields the Profile Type, Profile ID
+    and LR text of each stdResult."""
+
+    for _, elem in ET.iterparse(file, events=('end',), tag=_ITERPARSE_TAGS):
+        tag = elem.tag
+        if tag == 'stdResult':
+            yield elem.attrib["caseNumber"], elem.attrib["sample"], elem.findtext('lr')
+            # Free the finished result and any siblings already read
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        elif tag == 'databaseSearchResults':
+            parent = elem.getparent()
+            if parent is not None and parent.getparent() is None:
+                values[tag] = True
+        else:
+            # Keep only the first occurrence, matching a './/tag' find
+            values.setdefault(tag, elem.text)
+
+
+def _iterResultsPugixml(file, values):
+    """Reads a results file with pygixml, filling values and yielding
+    results the same way as _iterResultsLxml. The whole document is
+    loaded but it is walked only once."""
+
+    # The document must stay referenced while its nodes are in use
+    doc = pygixml.parse_file(file)
+    root = doc.root
+    if not root.child('databaseSearchResults').is_null():
+        values['databaseSearchResults'] = True
+    # Depth first in document order so the first occurrence of each tag is
+    #       the one a './/tag' find would return
+    for node in root.children(True):
+        tag = node.name
+        if tag == 'stdResult':
+            yield node.attribute('caseNumber').value, node.attribute('sample').value, node.child('lr').text()
+        elif tag in _SAMPLE_TAGS:
+            values.setdefault(tag, node.text())
+
+
+_iterResults = _iterResultsPugixml if pygixml is not None else _iterResultsLxml
 
 
 def parseResultsXMLFile(file):
     """Takes an XML file and parses it for values needed
     to construct a table of the various LR values. It
-    returns a list of the values of interest in the following
-    order: Case Number, Sample ID, Case Notes, Seed, Gelman Rubin,
-    AfAm Total LR, Af Am HPD LR, Af Am Unified LR, ...
-    for the three remaining NIST populations. If the XML file
-    is an LR from previous results file it will place a '0.0' in
-    the Gelman Rubin column as that data is not carried into the XML file
-    from the previous run."""
-
-    print(f"Current file: {file}")
-
-    tree = ET.parse(file)
+    returns a dictionary with an array of values for each of the
+    output COLUMNS, one entry per DB search result kept."""
 
     sampleData = []
 
-    lrData = []
-
-    if tree.find('./databaseSearchResults') is not None:
+    values = {}
+    resultsList = []
+    alreadyAppendedSet = set()
+
+    for profileType, sample, lr in _iterResults(file, values):
+        # removing duplicate entries with different names and same names
+        # check to see if any of these are needed for other experiments
+        if sample in duplicatesSet or sample == '40F':
+            continue
+        sample = _RENAMED_SAMPLES.get(sample, sample)
+        # If sample name already in set than already seen duplicate
+        # so discard this data
+        if sample in alreadyAppendedSet:
+            continue
+        alreadyAppendedSet.add(sample)
+        resultsList.append((profileType, sample, float(lr)))
+
+    if values.get('databaseSearchResults'):
         sampleData.append('DB Search')
     else:
         raise Exception(f"The file: {file} is not a DB search result file.")
 
-    caseNumber = tree.find('.//caseNumber').text
+    caseNumber = values['caseNumber']
     sampleData.append(caseNumber)
 
-    sampleID = tree.find('.//sampleId').text
+    sampleID = values['sampleId']
     sampleData.append(sampleID)
-    mixNumber = sampleID.split('_')[0]
-    trueContributorCount = str(sampleID.split('_')[1].count('-') + 1)
+    sampleIDParts = sampleID.split('_', 2)
+    mixNumber = sampleIDParts[0]
+    trueContributorCount = str(sampleIDParts[1].count('-') + 1)
 
-    if tree.find('.//caseNotes') is not None:
-        caseNotes = tree.find('.//caseNotes').text
-        sampleData.append(caseNotes)
-    else:
-        sampleData.append('')
+    caseNotes = values.get('caseNotes', '')
+    sampleData.append(caseNotes)
 
-    seed = tree.find('.//seed').text
+    seed = values['seed']
     sampleData.append(seed)
 
-    contributors = tree.find('.//contributors').text
+    contributors = values['contributors']
     sampleData.append(contributors)
     sampleData.append(trueContributorCount)
 
     # add in information for contributors but catch case for single source samples
     if 'SS' in mixNumber:
-        true_contrib = sampleID.split('_')[-1].split(' ')[0]
+        true_contrib = sampleID.rsplit('_', 1)[-1].split(' ', 1)[0]
         #print(f"True contributor for single source: {true_contrib}")
-        contrib_list = [true_contrib, '', '', '', '']
+        contrib_list = (true_contrib, '', '', '', '')
     else:
         contrib_list = contributorsList(mixNumber, trueContributorCount)
     sampleData.extend(contrib_list)
 
-    print(f"Sample ID: {sampleID}")
-    lowest_DNA = decon_data.loc[decon_data['Sample ID'] == sampleID]["Lowest DNA Amount"].values[0]
-
-    if tree.find('.//stdResult') is not None:
-        resultsList = [[x.attrib["caseNumber"], x.attrib["sample"], x.find('lr').text] for x in tree.findall('.//stdResult')]
-        #print(resultsList)
-        alreadyAppendedSet = set()
-        for result in resultsList:
-            temp = []
-            # print(result)
-            # removing duplicate entries with different names and same names
-            # check to see if any of these are needed for other experiments
-            if result[1] in duplicatesSet:
-                continue
-            elif result[1] == '40F':
-                continue
-
-            if result[1] == 'Mock_6':
-                result[1] = '40F'
-            # print(result[1])
-            # print(result)
-
-            # If sample name not already in set add to set
-            # if in set than already seen duplicate so discard this data
-            if result[1] not in alreadyAppendedSet:
-                # print("new")
-                alreadyAppendedSet.add(result[1])
-            else:
-                # print('old')
-                continue
+    log.debug("Sample ID: %s", sampleID)
+    lowest_DNA = _LOWEST_BY_SAMPLE.get(sampleID, 0.0)
+
+    trueOrNon = []
+    profileTypes = []
+    profileIDs = []
+    lrs = []
+    contrib_set = {c for c in contrib_list if c}
+    for profileType, profileID, lr in resultsList:
+        is_contrib = profileID in contrib_set
+        # Discard low LRs before keeping the result unless a true contributor
+        if is_contrib:
+            trueOrNon.append("True")
+        elif lr > LRCUTOFF:
+            trueOrNon.append("Non-Contributor")
+        else:
+            continue
+        profileTypes.append(profileType)
+        profileIDs.append(profileID)
+        lrs.append(lr)
+
+    # The sample values are the same for every result kept from this file
+    resultCount = len(lrs)
+    fileColumns = {column: np.repeat(columnArray(column, [value]), resultCount)
+                   for column, value in zip(COLUMNS, sampleData)}
+    fileColumns['True/Non'] = columnArray('True/Non', trueOrNon)
+    fileColumns['Template RFU'] = np.repeat(columnArray('Template RFU', [lowest_DNA]), resultCount)
+    fileColumns['Profile Type'] = columnArray('Profile Type', profileTypes)
+    fileColumns['Profile ID'] = columnArray('Profile ID', profileIDs)
+    fileColumns['LR'] = columnArray('LR', lrs)
+    return fileColumns
+
+
+def fileKey(file):
+    """Returns a key that is the same for every path to an unchanged file,
+    including symbolic and hard links: its device, inode, modified time
+    and size."""
+
+    stat = os.stat(file)
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _writeCSV(df, path):
+    """Writes a Data Frame to a CSV file with pyarrow if it is installed."""
+
+    if pa is None:
+        df.to_csv(path, index=False)
+        return
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path,
+                    write_options=pacsv.WriteOptions(include_header=True))
+
+
+def makeDataFrameAndExport(columns):
+    """Takes a dictionary of parsed XML data column arrays and turns it
+    into a Pandas Data Frame for export as a CSV file."""
+
+    df = pd.DataFrame(columns, columns=COLUMNS)
 
-            if result[1] in contrib_list:
-                #print(result[1])
-                #print(contrib_list)
-                true_or_non = "True"
+    # Write all the data to CSV files.
+    _writeCSV(df, 'DB_Search_LR_data.csv')
+
+    if NOC_OUTPUT == 'parquet':
+        for column, prefix in (("True Contributors", "TNOC"), ("Contributors", "ANOC")):
+            path = f'{prefix}_DB_Search_LR_data.parquet'
+            # Partitioned writes add to an existing dataset so remove the last run
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            if df.empty:
+                # A partitioned write of no rows makes nothing so still make
+                #       the dataset as a single empty partition for NOC 0,
+                #       which is never a real NOC. This keeps the same schema
+                #       as a dataset with results, where the partition column
+                #       is read back from the folder names as a categorical.
+                partition = os.path.join(path, f'{column}=0')
+                os.makedirs(partition)
+                fields = [pa.field(name, pa.from_numpy_dtype(COLUMN_DTYPES[name])
+                                   if name in COLUMN_DTYPES else pa.string())
+                          for name in COLUMNS if name != column]
+                pq.write_table(pa.schema(fields).empty_table(), os.path.join(partition, 'part-0.parquet'))
             else:
-                true_or_non = "Non-Contributor"
-            #print(template_RFU_amounts)
-            #lowest_template_RFU = min(filter(lambda i: i > 0, template_RFU_amounts))
-            #print(lowest_template_RFU)
-            if float(result[2]) > LRCUTOFF or result[1] in contrib_list:
-                temp.extend(sampleData)
-                temp.append(true_or_non)
-                temp.append(lowest_DNA)
-                temp.extend(result)
-                lrData.append(temp)
-
+                df.to_parquet(path, partition_cols=[column], index=False)
+        return
 
-    return lrData
+    # Split the data by true (TNOC) and apparent (ANOC) number of contributors.
+    #       Each column is grouped in one pass and empty files are still made
+    #       for any NOC from 1 to 5 that has no values.
+    for column, prefix in (("True Contributors", "TNOC"), ("Contributors", "ANOC")):
+        written = set()
+        for noc, df_noc in df.groupby(column, sort=False):
+            _writeCSV(df_noc, f'{prefix}_{noc}_DB_Search_LR_data.csv')
+            written.add(noc)
+        for noc in range(1, 6):
+            if noc not in written:
+                _writeCSV(df.iloc[:0], f'{prefix}_{noc}_DB_Search_LR_data.csv')
 
 
-def makeDataFrameAndExport(array):
-    """Takes an array of parsed XML data and turns it into
-    a Pandas Data Frame for export as a CSV file."""
+def findResultsFiles(root):
+    """Yields the path of the 'results.xml' file in each run folder
+    directly inside the root folder."""
 
-    df = pd.DataFrame(array,
-                      columns=['Run Type', 'Case Number', 'Sample ID', 'Case Notes',
-                               'Seed', 'Contributors', 'True Contributors',
-                               'Contributor 1', 'Contributor 2', 'Contributor 3',
-                               'Contributor 4', 'Contributor 5', 'True/Non', "Template RFU",
-                               'Profile Type', 'Profile ID', 'LR'])
+    for entry in os.scandir(root):
+        if entry.is_dir():
+            path = os.path.join(entry.path, 'results.xml')
+            if os.path.isfile(path):
+                yield path
 
-    df['Seed'] = df['Seed'].astype(int)
-    df['Contributors'] = df['Contributors'].astype(int)
-    df['True Contributors'] = df['True Contributors'].astype(int)
-    df['LR'] = df['LR'].astype(float)
 
+def configureLogging():
+    """Sets up logging for the main process and each pool worker.
+    Per file progress messages are at INFO so they are hidden by default."""
 
-    # Write all the data to CSV files.
-    df.to_csv('DB_Search_LR_data.csv', index=False)
-
-    df_TNoc1 = df[df["True Contributors"] == 1]
-    df_TNoc1.to_csv('TNOC_1_DB_Search_LR_data.csv', index=False)
-    df_TNoc2 = df[df["True Contributors"] == 2]
-    df_TNoc2.to_csv('TNOC_2_DB_Search_LR_data.csv', index=False)
-    df_TNoc3 = df[df["True Contributors"] == 3]
-    df_TNoc3.to_csv('TNOC_3_DB_Search_LR_data.csv', index=False)
-    df_TNoc4 = df[df["True Contributors"] == 4]
-    df_TNoc4.to_csv('TNOC_4_DB_Search_LR_data.csv', index=False)
-    df_TNoc5 = df[df["True Contributors"] == 5]
-    df_TNoc5.to_csv('TNOC_5_DB_Search_LR_data.csv', index=False)
-
-    df_ANoc1 = df[df["Contributors"] == 1]
-    df_ANoc1.to_csv('ANOC_1_DB_Search_LR_data.csv', index=False)
-    df_ANoc2 = df[df["Contributors"] == 2]
-    df_ANoc2.to_csv('ANOC_2_DB_Search_LR_data.csv', index=False)
-    df_ANoc3 = df[df["Contributors"] == 3]
-    df_ANoc3.to_csv('ANOC_3_DB_Search_LR_data.csv', index=False)
-    df_ANoc4 = df[df["Contributors"] == 4]
-    df_ANoc4.to_csv('ANOC_4_DB_Search_LR_data.csv', index=False)
-    df_ANoc5 = df[df["Contributors"] == 5]
-    df_ANoc5.to_csv('ANOC_5_DB_Search_LR_data.csv', index=False)
+    logging.basicConfig(level=logging.WARNING)
 
 
 def main():
-    # Using Test path with subfolder names as * wildcard
-    # Could specifically refer to file or use * wildcard
-    lr_array = []
-    for x in glob.glob(fr'{DIRECTORY}\*\results.xml', recursive=True):
-        print(f"Current file: {x}")
-        temp_array = (parseResultsXMLFile(x))
-        lr_array.extend(temp_array)
-    #print(lr_array)
-    makeDataFrameAndExport(lr_array)
+    configureLogging()
+
+    # Check the output setting before any files are parsed
+    if NOC_OUTPUT not in ('csv', 'parquet'):
+        raise Exception(f"NOC_OUTPUT must be 'csv' or 'parquet', not {NOC_OUTPUT!r}.")
+    if NOC_OUTPUT == 'parquet' and pa is None:
+        raise Exception("Writing Parquet output requires pyarrow to be installed.")
+
+    # Look in each run folder inside DIRECTORY for a results file
+    files = list(findResultsFiles(DIRECTORY))
+    # The same file found through more than one path is only parsed once
+    #       and its results are used for each of those paths.
+    file_keys = [fileKey(file) for file in files]
+    unique_files = {}
+    for key, file in zip(file_keys, files):
+        unique_files.setdefault(key, file)
+    # Each results file is independent so they are parsed in parallel.
+    #       The decon data and dictionaries above are module level so each
+    #       worker process has them whether it is forked or spawned.
+    #       Spawned workers do not run main so each one sets up logging.
+    for file in unique_files.values():
+        log.info("Current file: %s", file)
+    with multiprocessing.Pool(initializer=configureLogging) as pool:
+        parsed = dict(zip(unique_files, pool.map(parseResultsXMLFile, unique_files.values())))
+    per_file = [parsed[key] for key in file_keys]
+    # Join each column's per file arrays once
+    lr_columns = {}
+    for column in COLUMNS:
+        if per_file:
+            lr_columns[column] = np.concatenate([file_columns[column] for file_columns in per_file])
+        else:
+            lr_columns[column] = columnArray(column, [])
+    makeDataFrameAndExport(lr_columns)
 
 
 if __name__ == '__main__':